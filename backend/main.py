@@ -1,5 +1,5 @@
 
-import os, uuid, pathlib
+import os, re, uuid, pathlib, shutil, logging, threading
 from datetime import datetime, timedelta, date
 from typing import List, Optional
 from fastapi.staticfiles import StaticFiles
@@ -8,7 +8,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
 from jose import jwt, JWTError
 from pydantic import BaseModel
-from sqlalchemy import create_engine, ForeignKey, String, Boolean, Date, func, select, and_, or_, text, exists
+from sqlalchemy import create_engine, ForeignKey, String, Boolean, Date, func, select, and_, or_, text, exists, tuple_
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, sessionmaker, Session
 
 # --------------------- App (CREATE FIRST) ---------------------
@@ -40,7 +40,18 @@ JWT_ALG = "HS256"
 ACCESS_MIN = int(os.getenv("ACCESS_TOKEN_MINUTES", "120"))
 MAX_IMAGE_MB = int(os.getenv("MAX_IMAGE_MB", "10"))
 MAX_VIDEO_MB = int(os.getenv("MAX_VIDEO_MB", "100"))
+# Media reconciler: 0 disables the scheduled run (on-demand still works)
+MEDIA_GC_INTERVAL_MINUTES = int(os.getenv("MEDIA_GC_INTERVAL_MINUTES", "360"))
+# files younger than this are never treated as orphans (upload may not be committed yet)
+MEDIA_GC_GRACE_MINUTES = int(os.getenv("MEDIA_GC_GRACE_MINUTES", "60"))
+MEDIA_GC_BATCH = int(os.getenv("MEDIA_GC_BATCH", "1000"))
+# empty -> orphans are deleted; otherwise they are moved here (keep it outside UPLOAD_DIR)
+MEDIA_GC_QUARANTINE_DIR = os.getenv("MEDIA_GC_QUARANTINE_DIR", "")
+# abort (touching nothing) if more than this share of eligible files look orphaned,
+# e.g. DATABASE_URL points at an empty/restored DB or media_assets was truncated
+MEDIA_GC_MAX_ORPHAN_FRACTION = float(os.getenv("MEDIA_GC_MAX_ORPHAN_FRACTION", "0.5"))
 engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+logger = logging.getLogger("farmhouse")
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 
 class Base(DeclarativeBase):
@@ -180,6 +191,61 @@ class OwnerSetActiveIn(BaseModel):
 class ResetPasswordIn(BaseModel):
     new_password: str
 
+class MediaReconcileOut(BaseModel):
+    dry_run: bool
+    started_at: datetime
+    finished_at: Optional[datetime] = None
+    scanned_files: int = 0
+    skipped_recent: int = 0          # younger than MEDIA_GC_GRACE_MINUTES
+    orphans: int = 0                 # files with no media_assets row
+    orphan_bytes: int = 0
+    deleted: int = 0
+    quarantined: int = 0
+    reclaimed_bytes: int = 0
+    removed_dirs: int = 0            # empty dirs of farmhouses that no longer exist
+    missing: int = 0                 # media_assets rows with no file
+    missing_ids: List[int] = []      # first MEDIA_GC_SAMPLE only
+    errors: List[str] = []           # first MEDIA_GC_SAMPLE only
+    aborted: Optional[str] = None    # set when the orphan circuit breaker tripped
+
+
+# --------------------- Hot queries ---------------------
+# Shared with plan_check.py, which fails if any of these stops using its index.
+def user_lookup_query(ident: str):
+    return select(User).where(or_(User.email == ident, User.username == ident))
+
+def day_status_query(fid: int, start: date, end: date):
+    return select(DayStatus).where(
+        and_(DayStatus.farmhouse_id == fid, DayStatus.day >= start, DayStatus.day <= end)
+    ).order_by(DayStatus.day)
+
+def available_farmhouses_query(day: date, owner_id: Optional[int] = None):
+    # A farmhouse is "available" if there is NOT a booked row for that date.
+    booked_exists = exists(
+        select(DayStatus.id).where(
+            and_(
+                DayStatus.farmhouse_id == Farmhouse.id,
+                DayStatus.day == day,
+                DayStatus.is_booked == True
+            )
+        )
+    )
+    q = select(Farmhouse).where(~booked_exists)
+    if owner_id is not None:
+        q = q.where(Farmhouse.owner_id == owner_id)
+    return q
+
+def owner_page_query(offset: int, limit: int):
+    return (
+        select(User)
+        .where(User.role == "owner")
+        .order_by(User.id.asc())
+        .offset(offset)
+        .limit(limit)
+    )
+
+def owner_farmhouses_query(owner_id: int):
+    return select(Farmhouse).where(Farmhouse.owner_id == owner_id)
 
 # --------------------- DB utils ---------------------
 def get_db():
@@ -215,7 +281,7 @@ def get_current_user(
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    user = db.scalar(select(User).where(or_(User.email == ident, User.username == ident)))
+    user = db.scalar(user_lookup_query(ident))
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
 
@@ -247,9 +313,7 @@ def _init():
 # --------------------- Auth endpoints ---------------------
 @app.post("/auth/login", response_model=TokenOut)
 def login(form: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.scalar(
-        select(User).where(or_(User.email == form.username, User.username == form.username))
-    )
+    user = db.scalar(user_lookup_query(form.username))
     if not user or not verify_password(form.password, user.password_hash):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     if user.role != "admin" and not user.is_active:
@@ -307,11 +371,7 @@ def get_status(
         raise HTTPException(status_code=404, detail="Farmhouse not found")
     if current.role == "owner" and fh.owner_id != current.id:
         raise HTTPException(status_code=403, detail="Forbidden")
-    rows = db.scalars(
-        select(DayStatus).where(
-            and_(DayStatus.farmhouse_id == fid, DayStatus.day >= start, DayStatus.day <= end)
-        ).order_by(DayStatus.day)
-    ).all()
+    rows = db.scalars(day_status_query(fid, start, end)).all()
     return [DayStatusOut(day=r.day, is_booked=r.is_booked, note=r.note, admin_booked=r.admin_booked) for r in rows]
 
 @app.put("/farmhouses/{fid}/status", status_code=204)
@@ -387,17 +447,11 @@ def admin_list_owners(
         page = pages
 
     offset = (page - 1) * page_size
-    owners = db.scalars(
-        select(User)
-        .where(User.role == "owner")
-        .order_by(User.id.asc())
-        .offset(offset)
-        .limit(page_size)
-    ).all()
+    owners = db.scalars(owner_page_query(offset, page_size)).all()
 
     items: List[AdminOwnerRowOut] = []
     for o in owners:
-        fhs = db.scalars(select(Farmhouse).where(Farmhouse.owner_id == o.id)).all()
+        fhs = db.scalars(owner_farmhouses_query(o.id)).all()
         items.append(AdminOwnerRowOut(
             id=o.id, username=o.username, email=o.email, phone=o.phone, is_active=o.is_active,
             farmhouses=[FarmhouseBrief.model_validate(fh) for fh in fhs],
@@ -511,23 +565,9 @@ def available_farmhouses(
     db: Session = Depends(get_db),
     current: User = Depends(get_current_user)
 ):
-    # A farmhouse is "available" if there is NOT a booked row for that date.
-    booked_exists = exists(
-        select(DayStatus.id).where(
-            and_(
-                DayStatus.farmhouse_id == Farmhouse.id,
-                DayStatus.day == date,
-                DayStatus.is_booked == True
-            )
-        )
-    )
-    q = select(Farmhouse).where(~booked_exists)
-
     # Owners only see their own farmhouses
-    if current.role == "owner":
-        q = q.where(Farmhouse.owner_id == current.id)
-
-    rows = db.scalars(q).all()
+    owner_id = current.id if current.role == "owner" else None
+    rows = db.scalars(available_farmhouses_query(date, owner_id)).all()
     return rows
 
 # --------------------- Media endpoints ---------------------
@@ -568,11 +608,36 @@ def upload_media(
     if current.role == "owner" and fh.owner_id != current.id:
         raise HTTPException(status_code=403, detail="Forbidden")
 
-    allowed_prefix = ("image/", "video/")
-    saved: List[MediaOut] = []
+    written: List[str] = []
     dest_dir = os.path.join(UPLOAD_DIR, f"farmhouse_{fid}")
     os.makedirs(dest_dir, exist_ok=True)
 
+    try:
+        saved = _store_uploads(fid, files, dest_dir, written, db)
+        db.commit()
+    except Exception:
+        # nothing was committed, so every file written by this request is an orphan
+        db.rollback()
+        for fpath in written:
+            try:
+                os.remove(fpath)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logger.warning("could not remove uncommitted upload %s", fpath, exc_info=True)
+        raise
+    return saved
+
+
+def _store_uploads(
+    fid: int,
+    files: List[UploadFile],
+    dest_dir: str,
+    written: List[str],
+    db: Session,
+) -> List[MediaOut]:
+    allowed_prefix = ("image/", "video/")
+    saved: List[MediaOut] = []
     for up in files:
         if not up.content_type or not up.content_type.startswith(allowed_prefix):
             raise HTTPException(status_code=400, detail=f"Unsupported content type: {up.content_type}")
@@ -586,25 +651,20 @@ def upload_media(
         fpath = os.path.join(dest_dir, fname)
 
         size = 0
-        try:
-            with open(fpath, "wb") as out:
-                while True:
-                    chunk = up.file.read(1024 * 1024)
-                    if not chunk:
-                        break
-                    size += len(chunk)
-                    if size > byte_limit:
-                        raise HTTPException(
-                            status_code=413,
-                            detail=f"{kind.capitalize()} exceeds {limit_mb} MB limit"
-                        )
-                    out.write(chunk)
-        except HTTPException:
-            # remove partial file if limit exceeded
-            if os.path.exists(fpath):
-                try: os.remove(fpath)
-                except: pass
-            raise
+        # registered before opening so a partial file is cleaned up by the caller
+        written.append(fpath)
+        with open(fpath, "wb") as out:
+            while True:
+                chunk = up.file.read(1024 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > byte_limit:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"{kind.capitalize()} exceeds {limit_mb} MB limit"
+                    )
+                out.write(chunk)
 
         rec = MediaAsset(
             farmhouse_id=fid,
@@ -619,8 +679,6 @@ def upload_media(
             id=rec.id, farmhouse_id=fid, kind=kind, url=_media_url(fid, fname),
             mime_type=rec.mime_type, size_bytes=size, created_at=datetime.utcnow()
         ))
-
-    db.commit()
     return saved
 
 @app.delete("/farmhouses/{fid}/media/{mid}", status_code=204)
@@ -642,13 +700,235 @@ def delete_media(
     if current.role == "owner" and fh.owner_id != current.id:
         raise HTTPException(status_code=403, detail="Forbidden")
 
+    # Drop the row first: a file left behind is an orphan the reconciler can
+    # collect, whereas a row without its file would be served as a broken link.
     fpath = os.path.join(UPLOAD_DIR, f"farmhouse_{fid}", asset.filename)
+    db.delete(asset)
+    db.commit()
     try:
-        if os.path.exists(fpath):
-            os.remove(fpath)
-    except Exception:
-        # If file removal fails, still remove DB row to avoid dangling entries
+        os.remove(fpath)
+    except FileNotFoundError:
         pass
+    except OSError:
+        logger.warning("could not remove %s; left for the media reconciler", fpath, exc_info=True)
+
+
+# --------------------- Media reconciler ---------------------
+# Diffs UPLOAD_DIR against media_assets in both directions:
+#   file without a row -> orphan (deleted, or moved to MEDIA_GC_QUARANTINE_DIR)
+#   row without a file -> missing (logged and reported; the row is kept)
+# Directories are streamed with os.scandir and looked up in MEDIA_GC_BATCH
+# sized chunks, so memory stays flat no matter how many files are stored.
+MEDIA_GC_LOCK_KEY = 727001   # pg advisory lock, keeps API workers from overlapping
+MEDIA_GC_SAMPLE = 100
+_FARMHOUSE_DIR_RE = re.compile(r"farmhouse_(\d+)")
+
+def _note_error(report: MediaReconcileOut, msg: str) -> None:
+    logger.warning("media reconcile: %s", msg)
+    if len(report.errors) < MEDIA_GC_SAMPLE:
+        report.errors.append(msg)
+
+def _iter_farmhouse_dirs():
+    with os.scandir(UPLOAD_DIR) as top:
+        for d in top:
+            m = _FARMHOUSE_DIR_RE.fullmatch(d.name)
+            if m and d.is_dir(follow_symlinks=False):
+                yield int(m.group(1)), d.path
+
+def _iter_upload_files():
+    for fid, path in _iter_farmhouse_dirs():
+        with os.scandir(path) as it:
+            for f in it:
+                if f.is_file(follow_symlinks=False):
+                    yield fid, f
+
+def _batched(it, size: int):
+    batch = []
+    for item in it:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _reconcile_orphans(db: Session, report: MediaReconcileOut, dispose: bool) -> None:
+    cutoff = datetime.now().timestamp() - MEDIA_GC_GRACE_MINUTES * 60
+
+    def candidates():
+        for fid, entry in _iter_upload_files():
+            report.scanned_files += 1
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                _note_error(report, f"{entry.path}: {e}")
+                continue
+            if st.st_mtime > cutoff:
+                report.skipped_recent += 1
+                continue
+            yield fid, entry.name, entry.path, st.st_size
+
+    for batch in _batched(candidates(), MEDIA_GC_BATCH):
+        rows = db.execute(
+            select(MediaAsset.farmhouse_id, MediaAsset.filename).where(
+                tuple_(MediaAsset.farmhouse_id, MediaAsset.filename).in_(
+                    [(fid, name) for fid, name, _, _ in batch]
+                )
+            )
+        ).all()
+        db.rollback()  # read-only; don't hold a transaction open across file I/O
+        known = {(r.farmhouse_id, r.filename) for r in rows}
+
+        for fid, name, path, size in batch:
+            if (fid, name) in known:
+                continue
+            report.orphans += 1
+            report.orphan_bytes += size
+            if not dispose:
+                continue
+            try:
+                if MEDIA_GC_QUARANTINE_DIR:
+                    dest_dir = os.path.join(MEDIA_GC_QUARANTINE_DIR, f"farmhouse_{fid}")
+                    os.makedirs(dest_dir, exist_ok=True)
+                    shutil.move(path, os.path.join(dest_dir, name))
+                    report.quarantined += 1
+                else:
+                    os.remove(path)
+                    report.deleted += 1
+                report.reclaimed_bytes += size
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                _note_error(report, f"{path}: {e}")
+
+def _remove_stale_dirs(db: Session, report: MediaReconcileOut) -> None:
+    # farmhouse rows go away via ON DELETE CASCADE, leaving their directory behind
+    for batch in _batched(_iter_farmhouse_dirs(), MEDIA_GC_BATCH):
+        live = set(db.scalars(
+            select(Farmhouse.id).where(Farmhouse.id.in_([fid for fid, _ in batch]))
+        ).all())
+        db.rollback()
+        for fid, path in batch:
+            if fid in live:
+                continue
+            try:
+                os.rmdir(path)
+                report.removed_dirs += 1
+            except OSError:
+                pass  # not empty yet (e.g. recent files inside the grace window)
+
+def _reconcile_missing(db: Session, report: MediaReconcileOut) -> None:
+    last_id = 0
+    while True:
+        rows = db.execute(
+            select(MediaAsset.id, MediaAsset.farmhouse_id, MediaAsset.filename)
+            .where(MediaAsset.id > last_id)
+            .order_by(MediaAsset.id)
+            .limit(MEDIA_GC_BATCH)
+        ).all()
+        db.rollback()
+        if not rows:
+            return
+        for r in rows:
+            if not os.path.exists(os.path.join(UPLOAD_DIR, f"farmhouse_{r.farmhouse_id}", r.filename)):
+                report.missing += 1
+                if len(report.missing_ids) < MEDIA_GC_SAMPLE:
+                    report.missing_ids.append(r.id)
+                logger.warning("media reconcile: asset %s has no file (%s)", r.id, r.filename)
+        last_id = rows[-1].id
+
+def reconcile_media(db: Session, dry_run: bool = False) -> MediaReconcileOut:
+    report = MediaReconcileOut(dry_run=dry_run, started_at=datetime.utcnow())
+    # Count first; only a second pass removes anything, and only if the
+    # orphan share looks like normal churn rather than a missing database.
+    _reconcile_orphans(db, report, dispose=False)
+    eligible = report.scanned_files - report.skipped_recent
+    # checked on dry runs too, so a dry run shows whether the real run would abort
+    if report.orphans > eligible * MEDIA_GC_MAX_ORPHAN_FRACTION:
+        report.aborted = (
+            f"{report.orphans} of {eligible} files have no media_assets row "
+            f"(limit {MEDIA_GC_MAX_ORPHAN_FRACTION:.0%}); nothing was removed"
+        )
+        logger.error("media reconcile aborted: %s", report.aborted)
+    elif not dry_run and report.orphans:
+        report = MediaReconcileOut(dry_run=False, started_at=report.started_at)
+        _reconcile_orphans(db, report, dispose=True)
+    if not dry_run and not report.aborted:
+        _remove_stale_dirs(db, report)
+    _reconcile_missing(db, report)
+    report.finished_at = datetime.utcnow()
+    return report
+
+def run_media_reconcile(dry_run: bool = False) -> Optional[MediaReconcileOut]:
+    """One reconcile pass; returns None if another worker is already running one."""
+    with engine.connect() as lock_conn:
+        got = lock_conn.scalar(text("SELECT pg_try_advisory_lock(:k)"), {"k": MEDIA_GC_LOCK_KEY})
+        lock_conn.commit()  # session-level lock; don't sit idle in a transaction
+        if not got:
+            return None
+        try:
+            with SessionLocal() as db:
+                return reconcile_media(db, dry_run=dry_run)
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": MEDIA_GC_LOCK_KEY})
+            lock_conn.commit()
+
+# Runs are slow on big stores, so the endpoint and the schedule both hand them
+# to a thread; the last finished report (per API process) is kept for GET.
+_media_gc_stop = threading.Event()
+_media_gc_busy = threading.Lock()
+_media_gc_last: Optional[MediaReconcileOut] = None
+
+def _media_gc_run(dry_run: bool) -> None:
+    """Run one pass; the caller must already hold _media_gc_busy."""
+    global _media_gc_last
+    try:
+        report = run_media_reconcile(dry_run=dry_run)
+    except Exception:
+        logger.exception("media reconcile failed")
+        return
+    finally:
+        _media_gc_busy.release()
+    if report is None:
+        logger.info("media reconcile skipped: another worker is running one")
+        return
+    _media_gc_last = report
+    # WARNING so it shows under uvicorn's default logging; this is the only
+    # record of a scheduled run outside the process that ran it
+    logger.warning("media reconcile finished: %s", report.model_dump(exclude={"missing_ids", "errors"}))
+
+@app.post("/admin/media/reconcile", status_code=202)
+def admin_reconcile_media(
+    dry_run: bool = True,
+    current: User = Depends(get_current_user),
+):
+    if current.role != "admin":
+        raise HTTPException(status_code=403, detail="Admins only")
+    if not _media_gc_busy.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Media reconcile already running")
+    threading.Thread(target=_media_gc_run, args=(dry_run,), name="media-gc-manual", daemon=True).start()
+    return {"status": "started", "dry_run": dry_run}
 
-    db.delete(asset)
-    db.commit()
+@app.get("/admin/media/reconcile", response_model=MediaReconcileOut)
+def admin_last_media_reconcile(current: User = Depends(get_current_user)):
+    if current.role != "admin":
+        raise HTTPException(status_code=403, detail="Admins only")
+    if _media_gc_last is None:
+        raise HTTPException(status_code=404, detail="No reconcile report yet")
+    return _media_gc_last
+
+def _media_gc_loop():
+    while not _media_gc_stop.wait(MEDIA_GC_INTERVAL_MINUTES * 60):
+        if _media_gc_busy.acquire(blocking=False):
+            _media_gc_run(dry_run=False)
+
+@app.on_event("startup")
+def _start_media_gc():
+    if MEDIA_GC_INTERVAL_MINUTES > 0:
+        threading.Thread(target=_media_gc_loop, name="media-gc", daemon=True).start()
+
+@app.on_event("shutdown")
+def _stop_media_gc():
+    _media_gc_stop.set()
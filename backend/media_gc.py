@@ -0,0 +1,12 @@
+# backend/media_gc.py
+# Reconcile UPLOAD_DIR against media_assets once and print the report.
+#   python media_gc.py             -> delete (or quarantine) orphans
+#   python media_gc.py --dry-run   -> report only
+import sys
+from main import run_media_reconcile
+
+report = run_media_reconcile(dry_run="--dry-run" in sys.argv)
+if report is None:
+    print("Media reconcile already running")
+    sys.exit(1)
+print(report.model_dump_json(indent=2))
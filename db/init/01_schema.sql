@@ -35,6 +35,8 @@ CREATE TABLE IF NOT EXISTS day_status (
   UNIQUE(farmhouse_id, day)
 );
 CREATE INDEX IF NOT EXISTS idx_day_status_farmhouse_day ON day_status(farmhouse_id, day);
+-- available_farmhouses: booked rows for one date without scanning every farmhouse's calendar
+CREATE INDEX IF NOT EXISTS idx_day_status_booked_day ON day_status(day) WHERE is_booked;
 
 CREATE TABLE IF NOT EXISTS media_assets (
   id           SERIAL PRIMARY KEY,
@@ -47,3 +49,4 @@ CREATE TABLE IF NOT EXISTS media_assets (
 );
 CREATE INDEX IF NOT EXISTS idx_media_assets_farmhouse ON media_assets(farmhouse_id);
 CREATE INDEX IF NOT EXISTS idx_media_assets_created   ON media_assets(created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_media_assets_file      ON media_assets(farmhouse_id, filename);  -- media reconciler lookups